@@ -1,32 +1,40 @@
 """Generate Docker Compose configuration from scenario.toml"""
 
 import argparse
+import functools
+import json
 import os
 import re
 import sys
+import threading
+import time
 import base64
+import datetime
+import marshal
+import urllib.parse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Any
 
 # --- DEPENDENCIAS ---
+# tomllib (stdlib, Python 3.11+) primero; tomli solo como respaldo en versiones antiguas.
 try:
-    import tomli
+    import tomllib as tomli
 except ImportError:
     try:
-        import tomllib as tomli
+        import tomli
     except ImportError:
         print("Error: tomli required. Install with: pip install tomli")
         sys.exit(1)
+# orjson (opcional) decodifica más rápido las respuestas de la API; si no, json de stdlib.
 try:
-    import tomli_w
+    import orjson
+    _json_loads = orjson.loads
 except ImportError:
-    print("Error: tomli-w required. Install with: pip install tomli-w")
-    sys.exit(1)
-try:
-    import requests
-except ImportError:
-    print("Error: requests required. Install with: pip install requests")
-    sys.exit(1)
+    _json_loads = json.loads
+# requests se importa bajo demanda (get_session):
+# si todos los agentes ya tienen 'image' no pagamos el coste de importar requests.
 
 
 # --- CONFIGURACIÓN ---
@@ -36,12 +44,21 @@ A2A_SCENARIO_PATH = "a2a-scenario.toml"
 ENV_PATH = ".env.example"
 DEFAULT_PORT = 9009
 DEFAULT_ENV_VARS = {"PYTHONUNBUFFERED": "1"}
+MAX_FETCH_WORKERS = 16
+FETCH_TIMEOUT = (3.05, 27)  # (connect, read) en segundos
+AGENT_CACHE_DIR = Path.home() / ".cache" / "capsbench" / "agents"
+AGENT_CACHE_TTL = 3600.0  # segundos; se puede cambiar con AGENTBEATS_CACHE_TTL
+_ENV_VAR_RE = re.compile(r'\$\{([^}]+)\}')
+_IS_GHA = bool(os.environ.get("GITHUB_ACTIONS"))
+# Valor por defecto compartido para lecturas .get("env"/"config"). ¡No mutar!
+_EMPTY_DICT: dict[str, Any] = {}
+
 
 
 # --- 🛠️ SCRIPT DE REPARACIÓN MAESTRO (V6 - STREAMING SSE) ---
 # Se ejecuta DENTRO del contenedor.
 FIX_SCRIPT_SOURCE = r"""
-import sys, os, re, json, time, glob
+import sys, os, re, json, time
 
 print("🔧 [FIX] Iniciando reparación del servidor (Modo Streaming SSE)...", flush=True)
 
@@ -53,7 +70,7 @@ if not os.path.exists(target_file):
     print(f"❌ Error: No encuentro {target_file}", flush=True)
     sys.exit(1)
 
-with open(target_file, 'r') as f:
+with open(target_file, 'r', encoding='utf-8') as f:
     content = f.read()
 
 # === 1. ASEGURAR IMPORTS (Añadimos shutil para copiar archivos) ===
@@ -100,6 +117,28 @@ def serve_results(filename):
 
 # === 3. RPC FINAL: WRAPPER STRUCTURE + ID + COPIA ===
 new_dummy_rpc = r'''
+def _open_results_watcher(dirs):
+    # inotify (si inotify_simple está instalado) para despertar en cuanto se escribe un resultado.
+    # Solo CLOSE_WRITE/MOVED_TO: con CREATE leeríamos el JSON a medio escribir.
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None
+    try:
+        watcher = INotify()
+        watched = 0
+        for d in dirs:
+            if os.path.isdir(d):
+                watcher.add_watch(d, flags.CLOSE_WRITE | flags.MOVED_TO)
+                watched += 1
+        if watched:
+            print("👀 [STREAM] Esperando resultados con inotify.", flush=True)
+            return watcher
+        watcher.close()
+    except OSError:
+        pass
+    return None
+
 @app.route('/', methods=['POST', 'GET'])
 def dummy_rpc():
     print("🔒 [STREAM] Cliente conectado.", flush=True)
@@ -119,174 +158,347 @@ def dummy_rpc():
         }) + '\n\n'
         
         start_time = time.time()
+        results_dirs = ['/app/src/results', '/app/results', '/app/output', 'src/results']
+        watcher = _open_results_watcher(results_dirs)
+        last_beat = start_time
         
-        while True:
-            time.sleep(3) # Anti-Spam
-
-            patterns = ['/app/src/results/*.json', '/app/results/*.json', '/app/output/*.json', 'src/results/*.json']
-            files = []
-            for p in patterns:
-                files.extend(glob.glob(p))
-            
-            if files:
-                files.sort(key=os.path.getmtime, reverse=True)
-                last_file = files[0]
-                
-                if (time.time() - os.path.getmtime(last_file)) < 600:
-                    filename = os.path.basename(last_file)
-                    print(f"✅ [FIN] Detectado: {filename}", flush=True)
-
-                    # --- 👇 FIX: REESTRUCTURAR JSON (WRAPPER) 👇 ---
+        # try/finally: si el cliente SSE se desconecta llega GeneratorExit en un yield
+        # y hay que liberar igualmente el descriptor de inotify.
+        try:
+            while True:
+                # Sin inotify: sondeo cada 3s. Con inotify: como mucho 3s, o antes si llega un archivo.
+                if watcher is not None:
+                    watcher.read(timeout=3000)
+                else:
+                    time.sleep(3) # Anti-Spam
+
+                # Un solo scandir por carpeta: DirEntry ya trae el stat, sin glob + getmtime por archivo.
+                last_file = None
+                last_mtime = 0
+                for d in results_dirs:
                     try:
-                        # 1. Leemos el JSON original (Output del juego)
-                        with open(last_file, 'r') as f:
-                            game_data = json.load(f)
+                        with os.scandir(d) as entries:
+                            for entry in entries:
+                                if entry.name.startswith('.') or not entry.name.endswith('.json') or not entry.is_file():
+                                    continue
+                                mtime = entry.stat().st_mtime
+                                if last_file is None or mtime > last_mtime:
+                                    last_file, last_mtime = entry.path, mtime
+                    except OSError:
+                        continue
+            
+                if last_file:
+                    if (time.time() - last_mtime) < 600:
+                        filename = os.path.basename(last_file)
+                        print(f"✅ [FIN] Detectado: {filename}", flush=True)
+
+                        # --- 👇 FIX: REESTRUCTURAR JSON (WRAPPER) 👇 ---
+                        try:
+                            # 1. Leemos el JSON original (Output del juego)
+                            with open(last_file, 'r') as f:
+                                game_data = json.load(f)
                         
-                        # 2. Obtenemos tu UUID del entorno
-                        agent_id = os.environ.get("AGENT_ID")
+                            # 2. Obtenemos tu UUID del entorno
+                            agent_id = os.environ.get("AGENT_ID")
                         
-                        # 3. Verificamos si ya está envuelto (para no hacerlo dos veces)
-                        # Si tiene "benchmark_version" en la raíz, es el formato crudo que hay que envolver.
-                        if agent_id and "benchmark_version" in game_data:
-                            print(f"📦 Reestructurando JSON para Leaderboard...", flush=True)
+                            # 3. Verificamos si ya está envuelto (para no hacerlo dos veces)
+                            # Si tiene "benchmark_version" en la raíz, es el formato crudo que hay que envolver.
+                            if agent_id and "benchmark_version" in game_data:
+                                print(f"📦 Reestructurando JSON para Leaderboard...", flush=True)
                             
-                            # CREAMOS LA ESTRUCTURA "CORRECTA"
-                            wrapper = {
-                                "participants": {
-                                    "participant": agent_id
-                                },
-                                "results": [ game_data ]  # El juego original va DENTRO de esta lista
-                            }
+                                # CREAMOS LA ESTRUCTURA "CORRECTA"
+                                wrapper = {
+                                    "participants": {
+                                        "participant": agent_id
+                                    },
+                                    "results": [ game_data ]  # El juego original va DENTRO de esta lista
+                                }
                             
-                            # 4. Sobreescribimos el archivo con el formato nuevo
-                            with open(last_file, 'w') as f:
-                                json.dump(wrapper, f, indent=2)
+                                # 4. Sobreescribimos el archivo con el formato nuevo
+                                with open(last_file, 'w') as f:
+                                    json.dump(wrapper, f, indent=2)
                             
-                            print(f"✨ JSON transformado correctamente con ID: {agent_id}", flush=True)
+                                print(f"✨ JSON transformado correctamente con ID: {agent_id}", flush=True)
                             
-                    except Exception as e:
-                        print(f"⚠️ Error reestructurando JSON: {e}", flush=True)
-                    # -----------------------------------------------------
-
-                    # Copiar a Output (Volumen compartido)
-                    try:
-                        dest_path = "/app/output/results.json"
-                        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-                        shutil.copy(last_file, dest_path)
-                        print(f"📂 Archivo final copiado a: {dest_path}", flush=True)
-                    except Exception as e:
-                        print(f"⚠️ Error copiando archivo: {e}", flush=True)
-
-                    download_url = f"http://green-agent:9009/results/{filename}"
-
-                    final_msg = {
-                        "jsonrpc": "2.0", "id": 1,
-                        "result": {
-                            "contextId": ctx, "taskId": task,
-                            "final": True,
-                            "status": {"state": "completed"},
-                            "messageId": "msg-done", 
-                            "role": "assistant",
-                            "parts": [{"text": "Game Finished", "mimeType": "text/plain"}],
-                            "artifacts": [{
-                                "artifactId": "final-results",
-                                "name": "CapsBench Summary",
-                                "mimeType": "application/json",
-                                "url": download_url
-                            }]
+                        except Exception as e:
+                            print(f"⚠️ Error reestructurando JSON: {e}", flush=True)
+                        # -----------------------------------------------------
+
+                        # Copiar a Output (Volumen compartido)
+                        try:
+                            dest_path = "/app/output/results.json"
+                            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                            shutil.copy(last_file, dest_path)
+                            print(f"📂 Archivo final copiado a: {dest_path}", flush=True)
+                        except Exception as e:
+                            print(f"⚠️ Error copiando archivo: {e}", flush=True)
+
+                        download_url = f"http://green-agent:9009/results/{filename}"
+
+                        final_msg = {
+                            "jsonrpc": "2.0", "id": 1,
+                            "result": {
+                                "contextId": ctx, "taskId": task,
+                                "final": True,
+                                "status": {"state": "completed"},
+                                "messageId": "msg-done", 
+                                "role": "assistant",
+                                "parts": [{"text": "Game Finished", "mimeType": "text/plain"}],
+                                "artifacts": [{
+                                    "artifactId": "final-results",
+                                    "name": "CapsBench Summary",
+                                    "mimeType": "application/json",
+                                    "url": download_url
+                                }]
+                            }
                         }
-                    }
-                    yield "data: " + json.dumps(final_msg) + "\n\n"
-                    print("🏁 Stream cerrado correctamente.", flush=True)
-                    return 
+                        yield "data: " + json.dumps(final_msg) + "\n\n"
+                        print("🏁 Stream cerrado correctamente.", flush=True)
+                        return
             
-            if time.time() - start_time > 3600:
-                print("⏰ Timeout", flush=True)
-                break
+                if time.time() - start_time > 3600:
+                    print("⏰ Timeout", flush=True)
+                    break
                 
-            yield "data: " + json.dumps({
-                "jsonrpc": "2.0", "id": 1,
-                "result": {"contextId": ctx, "taskId": task, "final": False, "status": {"state": "working"}}
-            }) + '\n\n'
+                # Anti-Spam: los eventos de inotify no aceleran el latido de "working".
+                if time.time() - last_beat >= 3:
+                    last_beat = time.time()
+                    yield "data: " + json.dumps({
+                        "jsonrpc": "2.0", "id": 1,
+                        "result": {"contextId": ctx, "taskId": task, "final": False, "status": {"state": "working"}}
+                    }) + '\n\n'
+        finally:
+            if watcher is not None:
+                watcher.close()
 
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 '''
 
 # === 4. DESACTIVAR RUTAS ANTIGUAS ===
-content = re.sub(r"@app\.route\s*\(\s*['\"]/['\"]", "# @app.route('/'", content)
-content = re.sub(r"@app\.route\s*\(\s*['\"]/\.well-known/agent-card\.json['\"]", "# @app.route('/card'", content)
+# Una sola pasada para '/' y '/.well-known/agent-card.json'.
+old_routes = re.compile(r"@app\.route\s*\(\s*['\"](/|/\.well-known/agent-card\.json)['\"]")
+content = old_routes.sub(lambda m: "# @app.route('/'" if m.group(1) == "/" else "# @app.route('/card'", content)
 
 # === 5. INYECTAR CÓDIGO ===
-if "if __name__" in content:
-    parts = content.split("if __name__")
-    content = "".join(parts[:-1]) + "\n" + agent_card_route + "\n" + new_dummy_rpc + "\n\nif __name__" + parts[-1]
+head, sep, tail = content.rpartition("if __name__")
+if sep:
+    content = "".join([head, "\n", agent_card_route, "\n", new_dummy_rpc, "\n\nif __name__", tail])
 else:
     content += "\n" + agent_card_route + "\n" + serve_results_route + "\n" + new_dummy_rpc
 
 # === 6. GUARDAR Y EJECUTAR ===
-with open(target_file, 'w') as f:
+# Escritura atómica: archivo temporal + os.replace, nunca un green_agent.py a medias.
+tmp_file = target_file + '.tmp'
+with open(tmp_file, 'w', encoding='utf-8') as f:
     f.write(content)
+    f.flush()
+    os.fsync(f.fileno())
+os.replace(tmp_file, target_file)
 
 print("✅ Servidor parcheado (SSE Streaming). Arrancando...", flush=True)
 sys.stdout.flush()
 os.execvp("python", ["python", "-u", target_file] + sys.argv[1:])
 """
 
-# Codificamos el script en Base64
-FIX_SCRIPT_B64 = base64.b64encode(FIX_SCRIPT_SOURCE.encode('utf-8')).decode('utf-8')
+@functools.cache
+def _fix_script_b64() -> str:
+    # Codificamos el script en Base64 solo cuando se genera el compose (no al importar).
+    return base64.b64encode(FIX_SCRIPT_SOURCE.encode('utf-8')).decode('utf-8')
+
+
+@functools.cache
+def _fix_script_code_b64() -> str:
+    # Bytecode ya compilado: el contenedor se ahorra tokenizar/compilar el script al arrancar.
+    # Solo es válido si el Python del contenedor coincide con el de este generador.
+    code = compile(FIX_SCRIPT_SOURCE, "fix_server", "exec", optimize=2)
+    return base64.b64encode(marshal.dumps(code)).decode('utf-8')
+
+
+def fix_script_loader(green: dict[str, Any]) -> str:
+    """Return the `python -c` one-liner that decodes and runs the fix script in memory.
+
+    Marshalled bytecode is shipped only when green_agent.python_version matches
+    this interpreter's major.minor; otherwise the image's Python is unknown and
+    the source is shipped instead. The bytecode loader re-checks the version in
+    the container and exits with a clear message rather than unmarshalling
+    bytecode from another Python.
+    """
+    major, minor = sys.version_info[:2]
+    if str(green.get("python_version", "")) == f"{major}.{minor}":
+        return (
+            f"import sys,base64,marshal;"
+            f"sys.version_info[:2]==({major},{minor}) or sys.exit("
+            f"'Error: green_agent.python_version is {major}.{minor} but the image runs '+sys.version.split()[0]);"
+            f"exec(marshal.loads(base64.b64decode('{_fix_script_code_b64()}')))"
+        )
+    return f"import base64;exec(compile(base64.b64decode('{_fix_script_b64()}'),'fix_server','exec'))"
+
 
+def agent_cache_path(agentbeats_id: str) -> Path:
+    return AGENT_CACHE_DIR / f"{urllib.parse.quote(agentbeats_id, safe='')}.json"
 
+
+def save_agent_cache(agentbeats_id: str, info: dict) -> None:
+    """Store one API response as {"fetched_at", "payload"} in its own cache file."""
+    path = agent_cache_path(agentbeats_id)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        AGENT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path.write_text(json.dumps({"fetched_at": time.time(), "payload": info}))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: Failed to write agent cache {path}: {e}")
+
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def get_session():
+    """Return the shared requests.Session, importing requests on first use.
+
+    The session reuses TCP/TLS connections (keep-alive) across API calls and
+    retries transient server errors with backoff.
+    """
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            try:
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+            except ImportError:
+                print("Error: requests required. Install with: pip install requests")
+                sys.exit(1)
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(
+                max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+                pool_connections=MAX_FETCH_WORKERS,
+                pool_maxsize=MAX_FETCH_WORKERS,
+            ))
+            _SESSION = session
+        return _SESSION
+
+
+def _agent_cache_ttl() -> float:
+    """Return AGENTBEATS_CACHE_TTL in seconds, or AGENT_CACHE_TTL if it is unset."""
+    ttl = os.environ.get("AGENTBEATS_CACHE_TTL")
+    if ttl is None:
+        return AGENT_CACHE_TTL
+    try:
+        return float(ttl)
+    except ValueError:
+        print(f"Error: AGENTBEATS_CACHE_TTL must be a number of seconds, got {ttl!r}")
+        sys.exit(1)
+
+
+def cached_agent_info(agentbeats_id: str) -> dict | None:
+    """Return the cached agent info if it is younger than the cache TTL."""
+    ttl = _agent_cache_ttl()
+    try:
+        cached = _json_loads(agent_cache_path(agentbeats_id).read_bytes())
+        if time.time() - cached["fetched_at"] < ttl:
+            return cached["payload"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+@functools.cache
 def fetch_agent_info(agentbeats_id: str) -> dict:
+    cached = cached_agent_info(agentbeats_id)
+    if cached is not None:
+        return cached
+
     url = f"{AGENTBEATS_API_URL}/{agentbeats_id}"
     try:
-        response = requests.get(url, timeout=30)
+        response = get_session().get(url, timeout=FETCH_TIMEOUT)
         response.raise_for_status()
-        return response.json()
+        info = _json_loads(response.content)
     except Exception as e:
         print(f"Error: Failed to fetch agent {agentbeats_id}: {e}")
         sys.exit(1)
 
+    save_agent_cache(agentbeats_id, info)
+    return info
+
+
+def fetch_agents_info(agentbeats_ids: list[str]) -> dict[str, dict]:
+    """Fetch several agents concurrently; returns a dict keyed by agentbeats_id.
+
+    Ids with a fresh cache entry are served synchronously; only the rest hit the API.
+    """
+    infos = {}
+    missing = []
+    for agentbeats_id in agentbeats_ids:
+        info = cached_agent_info(agentbeats_id)
+        if info is None:
+            missing.append(agentbeats_id)
+        else:
+            infos[agentbeats_id] = info
+
+    if missing:
+        workers = min(MAX_FETCH_WORKERS, len(missing))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            infos.update(zip(missing, executor.map(fetch_agent_info, missing)))
+
+    return infos
+
 
-def resolve_image(agent: dict, name: str) -> None:
+def resolve_image(agent: dict, name: str, info: dict | None = None) -> None:
     has_image = "image" in agent
     has_id = "agentbeats_id" in agent
 
+    # Caso habitual (CI): solo agentbeats_id.
+    if has_id and not has_image:
+        if info is None:
+            info = fetch_agent_info(agent["agentbeats_id"])
+        agent["image"] = info["docker_image"]
+        if "id" in info:
+            agent["webhook_id"] = info["id"]
+        print(f"Resolved {name} image: {agent['image']}")
+        return
+
     if has_image and has_id:
         print(f"Error: {name} has both 'image' and 'agentbeats_id'")
         sys.exit(1)
     elif has_image:
-        if os.environ.get("GITHUB_ACTIONS"):
+        if _IS_GHA:
             print(f"Error: {name} requires 'agentbeats_id' for GitHub Actions")
             sys.exit(1)
         print(f"Using {name} image: {agent['image']}")
-    elif has_id:
-        info = fetch_agent_info(agent["agentbeats_id"])
-        agent["image"] = info["docker_image"]
-        if "id" in info:
-            agent["webhook_id"] = info["id"]
-        print(f"Resolved {name} image: {agent['image']}")
     else:
         print(f"Error: {name} must have 'image' or 'agentbeats_id'")
         sys.exit(1)
 
 
 def parse_scenario(scenario_path: Path) -> dict[str, Any]:
-    toml_data = scenario_path.read_text()
-    data = tomli.loads(toml_data)
+    with scenario_path.open("rb") as f:
+        data = tomli.load(f)
 
     green = data.get("green_agent", {})
-    resolve_image(green, "green_agent")
-
     participants = data.get("participants", [])
-    names = [p.get("name") for p in participants]
-    duplicates = [name for name in set(names) if names.count(name) > 1]
+    counts = Counter(p.get("name") for p in participants)
+    if None in counts:
+        print("Error: Every participant must have a 'name'")
+        sys.exit(1)
+    duplicates = [name for name, count in counts.items() if count > 1]
     if duplicates:
         print(f"Error: Duplicate participant names: {duplicates}")
         sys.exit(1)
 
-    for participant in participants:
-        name = participant.get("name", "unknown")
-        resolve_image(participant, f"participant '{name}'")
+    agents = [(green, "green_agent")]
+    agents += [(p, f"participant '{p.get('name', 'unknown')}'") for p in participants]
+
+    # Resolvemos todos los agentbeats_id en paralelo (una sola ronda de red).
+    pending_ids = list(dict.fromkeys(
+        agent["agentbeats_id"] for agent, _ in agents
+        if "agentbeats_id" in agent and "image" not in agent
+    ))
+    infos = fetch_agents_info(pending_ids)
+
+    for agent, name in agents:
+        resolve_image(agent, name, infos.get(agent.get("agentbeats_id")))
 
     return data
 
@@ -300,11 +512,18 @@ services:
     platform: linux/amd64
     container_name: green-agent
     
-    # 👇 FIX ROBUSTO: Decodifica el script B64 y lo ejecuta.
+    # 👇 FIX ROBUSTO: Python decodifica el script B64 y lo ejecuta en memoria (sin shell ni /tmp).
     entrypoint: 
-      - /bin/sh
+      - python
+      - -u
       - -c
-      - "echo {fix_b64} | base64 -d > /tmp/fix_server.py && python /tmp/fix_server.py --host 0.0.0.0 --port {green_port} --card-url http://green-agent:{green_port}"
+      - "{fix_loader}"
+      - --host
+      - 0.0.0.0
+      - --port
+      - "{green_port}"
+      - --card-url
+      - http://green-agent:{green_port}
 
     environment:{green_env}
     # 👇 FIX CRÍTICO: ¡Añadimos el volumen aquí también!
@@ -375,96 +594,184 @@ endpoint = "http://green-agent:{green_port}"
 {config}"""
 
 
+_DEFAULT_ENV_LINES = [f"      - {key}={value}" for key, value in DEFAULT_ENV_VARS.items()]
+
+
 def format_env_vars(env_dict: dict[str, Any]) -> str:
-    env_vars = {**DEFAULT_ENV_VARS, **env_dict}
-    lines = [f"      - {key}={value}" for key, value in env_vars.items()]
-    return "\n" + "\n".join(lines)
+    # Memoizado por (clave, tipo, valor) en orden: agentes con el mismo env comparten resultado.
+    # El tipo va en la clave porque True == 1 == 1.0 y se renderizan distinto.
+    key = tuple((k, type(v), v) for k, v in env_dict.items())
+    try:
+        hash(key)
+    except TypeError:  # algún valor no es hashable (p. ej. una lista)
+        return _render_env_vars(env_dict)
+    return _format_env_items(key)
 
 
-def generate_docker_compose(scenario: dict[str, Any]) -> str:
-    green = scenario["green_agent"]
-    participants = scenario.get("participants", [])
+@functools.cache
+def _format_env_items(items: tuple[tuple[str, type, Any], ...]) -> str:
+    return _render_env_vars({k: v for k, _, v in items})
+
+
+def _render_env_vars(env_dict: dict[str, Any]) -> str:
+    if env_dict.keys().isdisjoint(DEFAULT_ENV_VARS):
+        # Caso habitual: reutilizamos las líneas por defecto ya renderizadas.
+        lines = _DEFAULT_ENV_LINES + [f"      - {key}={value}" for key, value in env_dict.items()]
+    else:
+        # El agente sobrescribe algún valor por defecto: mantenemos su posición original.
+        env_vars = {**DEFAULT_ENV_VARS, **env_dict}
+        lines = [f"      - {key}={value}" for key, value in env_vars.items()]
+    return "\n" + "\n".join(lines)
+
 
+def _set_green_agent_id(green: dict[str, Any], participants: list[dict[str, Any]]) -> None:
     # --- 👇 FIX: PASAR UUID AL ENTORNO 👇 ---
-    if participants:
-        p_data = participants[0]
-        # Obtenemos el UUID real
-        participant_uuid = p_data.get("webhook_id") or p_data.get("agentbeats_id")
-        
-        if participant_uuid:
-            if "env" not in green:
-                green["env"] = {}
-            # Pasamos el UUID como variable de entorno
-            green["env"]["AGENT_ID"] = participant_uuid
-            print(f"ℹ️ Configurando ID para el wrapper: {participant_uuid}")
-    # ----------------------------------------
-
-    participant_names = [p["name"] for p in participants]
-
-    participant_services = "\n".join([
-        PARTICIPANT_TEMPLATE.format(
-            name=p["name"],
-            image=p["image"],
-            port=DEFAULT_PORT,
-            env=format_env_vars(p.get("env", {}))
-        )
-        for p in participants
-    ])
+    if not participants:
+        return
+    p_data = participants[0]
+    # Obtenemos el UUID real
+    participant_uuid = p_data.get("webhook_id") or p_data.get("agentbeats_id")
+
+    if participant_uuid:
+        if "env" not in green:
+            green["env"] = {}
+        # Pasamos el UUID como variable de entorno
+        green["env"]["AGENT_ID"] = participant_uuid
+        print(f"ℹ️ Configurando ID para el wrapper: {participant_uuid}")
+
+
+def _render_participant_service(p: dict[str, Any]) -> str:
+    return PARTICIPANT_TEMPLATE.format(
+        name=p["name"],
+        image=p["image"],
+        port=DEFAULT_PORT,
+        env=format_env_vars(p.get("env", _EMPTY_DICT)),
+    )
+
 
+def _render_compose(green: dict[str, Any], participant_services: list[str]) -> str:
     return COMPOSE_TEMPLATE.format(
         green_image=green["image"],
         green_port=DEFAULT_PORT,
-        green_env=format_env_vars(green.get("env", {})),
+        green_env=format_env_vars(green.get("env", _EMPTY_DICT)),
         green_depends=" []",  
-        participant_services=participant_services,
+        participant_services="\n".join(participant_services),
         client_depends=" []", 
-        fix_b64=FIX_SCRIPT_B64
+        fix_loader=fix_script_loader(green)
     )
 
 
-def generate_a2a_scenario(scenario: dict[str, Any]) -> str:
+def generate_docker_compose(scenario: dict[str, Any]) -> str:
     green = scenario["green_agent"]
     participants = scenario.get("participants", [])
+    _set_green_agent_id(green, participants)
+    return _render_compose(green, [_render_participant_service(p) for p in participants])
+
+
+_TOML_BARE_KEY_RE = re.compile(r'[A-Za-z0-9_-]+')
+
+
+def _toml_key(key: str) -> str:
+    return key if _TOML_BARE_KEY_RE.fullmatch(key) else _toml_value(key)
+
+
+def _toml_value(value: Any) -> str:
+    # bool antes que int: bool es subclase de int.
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        # json.dumps produce escapes válidos en TOML; solo falta DEL (U+007F).
+        return json.dumps(value, ensure_ascii=False).replace("\x7f", "\\u007f")
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, list):
+        return "[" + ", ".join(_toml_value(item) for item in value) + "]"
+    if isinstance(value, dict):
+        items = ", ".join(f"{_toml_key(k)} = {_toml_value(v)}" for k, v in value.items())
+        return "{ " + items + " }" if items else "{}"
+    raise TypeError(f"Unsupported TOML value in [config]: {value!r}")
 
-    participant_lines = []
-    for p in participants:
-        lines = [
-            f"[[participants]]",
-            f"role = \"{p['name']}\"",
-            f"endpoint = \"http://{p['name']}:{DEFAULT_PORT}\"",
-        ]
-        if "webhook_id" in p:
-             lines.append(f"agentbeats_id = \"{p['webhook_id']}\"")
-        elif "agentbeats_id" in p:
-             lines.append(f"agentbeats_id = \"{p['agentbeats_id']}\"")
-        participant_lines.append("\n".join(lines) + "\n")
-
-    config_section = scenario.get("config", {})
-    config_lines = [tomli_w.dumps({"config": config_section})]
+
+def _toml_dump_config(config: dict[str, Any]) -> str:
+    """Serialize the scenario's [config] table (replaces tomli_w for this one table)."""
+    lines = ["[config]"]
+    lines += [f"{_toml_key(key)} = {_toml_value(value)}" for key, value in config.items()]
+    return "\n".join(lines) + "\n"
+
+
+def _render_a2a_participant(p: dict[str, Any]) -> str:
+    lines = [
+        f"[[participants]]",
+        f"role = \"{p['name']}\"",
+        f"endpoint = \"http://{p['name']}:{DEFAULT_PORT}\"",
+    ]
+    if "webhook_id" in p:
+         lines.append(f"agentbeats_id = \"{p['webhook_id']}\"")
+    elif "agentbeats_id" in p:
+         lines.append(f"agentbeats_id = \"{p['agentbeats_id']}\"")
+    return "\n".join(lines) + "\n"
+
+
+def _render_a2a_scenario(scenario: dict[str, Any], participant_blocks: list[str]) -> str:
+    config_section = scenario.get("config", _EMPTY_DICT)
 
     return A2A_SCENARIO_TEMPLATE.format(
         green_port=DEFAULT_PORT,
-        participants="\n".join(participant_lines),
-        config="\n".join(config_lines)
+        participants="\n".join(participant_blocks),
+        config=_toml_dump_config(config_section)
     )
 
 
-def generate_env_file(scenario: dict[str, Any]) -> str:
-    green = scenario["green_agent"]
+def generate_a2a_scenario(scenario: dict[str, Any]) -> str:
     participants = scenario.get("participants", [])
-    secrets = set()
-    env_var_pattern = re.compile(r'\$\{([^}]+)\}')
+    return _render_a2a_scenario(scenario, [_render_a2a_participant(p) for p in participants])
+
+
+def _collect_secrets(agent: dict[str, Any], secrets: set[str]) -> None:
+    secrets.update(
+        match.group(1)
+        for value in agent.get("env", _EMPTY_DICT).values()
+        for match in _ENV_VAR_RE.finditer(str(value))
+    )
 
-    for agent in [green] + participants:
-        for value in agent.get("env", {}).values():
-            for match in env_var_pattern.findall(str(value)):
-                secrets.add(match)
 
+def _render_env_file(secrets: set[str]) -> str:
     if not secrets: return ""
     lines = [f"{secret}=" for secret in sorted(secrets)]
     return "\n".join(lines) + "\n"
 
 
+def generate_env_file(scenario: dict[str, Any]) -> str:
+    secrets = set()
+    for agent in (scenario["green_agent"], *scenario.get("participants", [])):
+        _collect_secrets(agent, secrets)
+    return _render_env_file(secrets)
+
+
+def generate_all(scenario: dict[str, Any]) -> tuple[str, str, str]:
+    """Build (docker-compose.yml, a2a-scenario.toml, .env.example) in a single pass over the participants."""
+    green = scenario["green_agent"]
+    participants = scenario.get("participants", [])
+    _set_green_agent_id(green, participants)
+
+    services = []
+    a2a_blocks = []
+    secrets = set()
+    _collect_secrets(green, secrets)
+    for p in participants:
+        services.append(_render_participant_service(p))
+        a2a_blocks.append(_render_a2a_participant(p))
+        _collect_secrets(p, secrets)
+
+    return (
+        _render_compose(green, services),
+        _render_a2a_scenario(scenario, a2a_blocks),
+        _render_env_file(secrets),
+    )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--scenario", type=Path)
@@ -476,16 +783,13 @@ def main():
 
     scenario = parse_scenario(args.scenario)
 
-    with open(COMPOSE_PATH, "w") as f:
-        f.write(generate_docker_compose(scenario))
+    compose_content, a2a_content, env_content = generate_all(scenario)
 
-    with open(A2A_SCENARIO_PATH, "w") as f:
-        f.write(generate_a2a_scenario(scenario))
+    Path(COMPOSE_PATH).write_bytes(compose_content.encode("utf-8"))
+    Path(A2A_SCENARIO_PATH).write_bytes(a2a_content.encode("utf-8"))
 
-    env_content = generate_env_file(scenario)
     if env_content:
-        with open(ENV_PATH, "w") as f:
-            f.write(env_content)
+        Path(ENV_PATH).write_bytes(env_content.encode("utf-8"))
         print(f"Generated {ENV_PATH}")
 
     print(f"Generated {COMPOSE_PATH} and {A2A_SCENARIO_PATH} (FINAL STREAMING FIX - BASELINE)")